@@ -1,344 +1,572 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-import tempfile, os, logging, shutil, gc
-from typing import Dict, Any
+from fastapi.concurrency import run_in_threadpool
+import tempfile, os, errno, socket, ipaddress, logging, shutil, gc, hashlib, contextlib, asyncio, multiprocessing, time, base64, functools, operator, mmap
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from array import array
+from itertools import chain
+from typing import Dict, Any, List, Optional, Union
+from contextlib import asynccontextmanager
 
 # Logging detalhado
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
 
+# Mesma exceção repetida em menos de 1s (ex.: lote de PDFs escaneados quebrados) é descartada
+class _FiltroExcecoesRepetidas(logging.Filter):
+    JANELA_S = 1.0
+    
+    def __init__(self):
+        super().__init__()
+        self._vistas = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not record.exc_info or record.exc_info[1] is None:
+            return True
+        tipo, erro = record.exc_info[0], record.exc_info[1]
+        chave = tipo.__name__ + str(erro)[:64]
+        agora = time.monotonic()
+        if agora - self._vistas.get(chave, float("-inf")) < self.JANELA_S:
+            return False
+        if len(self._vistas) > 1024:
+            self._vistas.clear()
+        self._vistas[chave] = agora
+        return True
+
+logger.addFilter(_FiltroExcecoesRepetidas())
+
 # Pasta para imagens
 IMAGES_DIR = "/tmp/docling_images"
 os.makedirs(IMAGES_DIR, exist_ok=True)
+# Imagens mais antigas que isso são removidas pela limpeza em background
+IMAGES_TTL_MIN = int(os.getenv("DOCLING_IMAGES_TTL_MIN", "60"))
+
+# Upload é copiado para o disco em blocos de 1 MiB (sem carregar o PDF inteiro na RAM)
+CHUNK_UPLOAD = 1 << 20
+
+# Extensões aceitas no upload (só PDF por enquanto)
+EXTENSOES_ACEITAS = frozenset({".pdf"})
+
+# PDFs até este tamanho vão direto da memória para o Docling (sem arquivo temporário)
+FILE_SIZE_MB_THRESHOLD = 4
+
+# Pasta dos temporários dos PDFs maiores. DOCLING_TMPDIR=/dev/shm deixa em tmpfs (RAM, sem disco),
+# mas só se o shm for grande: no Docker o padrão é 64MB e a RAM é a mesma que o Granite usa.
+# Sem espaço (ENOSPC) no DOCLING_TMPDIR, o upload é copiado de novo para o temp do sistema
+TMP_DIR_SISTEMA = tempfile.gettempdir()
+TMP_DIR = os.getenv("DOCLING_TMPDIR") or TMP_DIR_SISTEMA
+
+# Imagens acima disso (largura x altura) são reduzidas e salvas em WEBP; 0 desliga (448x448 por padrão)
+MAX_PIXELS_PADRAO = 200_704
+
+# Lote: máximo de PDFs por request e de lotes em andamento (cada lote segura um worker inteiro)
+MAX_ARQUIVOS_LOTE = int(os.getenv("DOCLING_MAX_ARQUIVOS_LOTE", "16"))
+MAX_LOTES = int(os.getenv("DOCLING_MAX_LOTES", "1"))
+
+# Limite conservador de tamanho para Granite
+MAX_UPLOAD_MB = 25
+
+# Cache de resultados por hash do conteúdo (LRU em disco)
+CACHE_DIR = "/tmp/docling_cache"
+os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_MAX_MB = int(os.getenv("DOCLING_CACHE_MAX_MB", "512"))
+
+# Índice URL (+ ETag) -> hash do conteúdo: PDF remoto já conhecido nem é baixado de novo
+URLS_DIR = os.path.join(CACHE_DIR, "urls")
+os.makedirs(URLS_DIR, exist_ok=True)
+DOWNLOAD_TIMEOUT_S = float(os.getenv("DOCLING_DOWNLOAD_TIMEOUT_S", "60"))
+# /convert-url busca URLs passadas pelo cliente (sem auth): desligado por padrão e só liga com a lista
+# de hosts em DOCLING_URL_HOSTS. A checagem de IP resolve o DNS separado do httpx (DNS rebinding passa),
+# então a lista é o que segura de verdade; endereços internos (loopback, privados, ...) são recusados também
+URL_HOSTS_PERMITIDOS = frozenset(h.strip().lower() for h in os.getenv("DOCLING_URL_HOSTS", "").split(",") if h.strip())
+URL_HABILITADA = os.getenv("DOCLING_CONVERT_URL", "0") == "1" and bool(URL_HOSTS_PERMITIDOS)
+if os.getenv("DOCLING_CONVERT_URL", "0") == "1" and not URL_HOSTS_PERMITIDOS:
+    logger.error("❌ DOCLING_CONVERT_URL=1 sem DOCLING_URL_HOSTS: /convert-url continua desabilitado")
+MAX_REDIRECTS = 5
+
+# Trocar sempre que a configuração do pipeline mudar (invalida o cache antigo)
+ASSINATURA_OPCOES = "granite-vision|tabelas=fast|imagens|escala=1|v3"
+
+# PDF digital: mínimo de caracteres em TODAS as páginas para o OCR ser pulado
+MIN_CHARS_POR_PAGINA = 50
+
+# Kernels CUDA carregados sob demanda (startup mais rápido, menos memória por worker)
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
+
+# Precisão do torch: TF32 nas matmuls/convoluções FP32 (Ampere+), antes do Docling carregar os modelos
+try:
+    import torch
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+except ImportError:
+    torch = None
+
+# torch.compile + CUDA Graphs no Granite (opcional, só com CUDA)
+TORCH_COMPILE = os.getenv("DOCLING_TORCH_COMPILE", "0") == "1" and torch is not None and torch.cuda.is_available()
 
 # Import Docling
 try:
     from docling.document_converter import DocumentConverter, PdfFormatOption
-    from docling.datamodel.base_models import InputFormat
-    from docling.datamodel.pipeline_options import PdfPipelineOptions, granite_picture_description
+    from docling.datamodel.base_models import InputFormat, DocumentStream, ConversionStatus
+    from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode, granite_picture_description
     DOCLING_OK = True
     logger.info("✅ Docling + Granite carregado")
 except ImportError as e:
     DOCLING_OK = False
-    logger.error(f"❌ Erro Docling: {e}")
+    logger.error("❌ Erro Docling: %s", e)
+
+# httpx (HTTP/2 + pool de conexões) para o /convert-url
+try:
+    import httpx
+    HTTPX_OK = True
+except ImportError:
+    HTTPX_OK = False
+
+# pypdfium2 (já vem com o Docling) para detectar PDFs com camada de texto
+try:
+    import pypdfium2 as pdfium
+    PDFIUM_OK = True
+except ImportError:
+    PDFIUM_OK = False
+
+# Combinações (ocr, tabelas) atendidas pelo /convert. Cada uma é um pipeline Granite completo
+# (VLM + layout + TableFormer) carregado em CADA worker no startup: a memória cresce com
+# combinações x DOCLING_WORKERS, então habilitar só o necessário. Outras combinações dão 400.
+# Padrão inclui "sem_ocr": é o que PDFs digitais (e ocr=false) usam
+COMBINACOES = {"completo": (True, True), "sem_ocr": (False, True), "sem_tabelas": (True, False), "minimo": (False, False)}
+_nomes_combinacoes = [n.strip() for n in os.getenv("DOCLING_COMBINACOES", "completo,sem_ocr").split(",") if n.strip()]
+for _nome in _nomes_combinacoes:
+    if _nome not in COMBINACOES:
+        raise ValueError(f"DOCLING_COMBINACOES: '{_nome}' inválida (opções: {', '.join(COMBINACOES)})")
+COMBINACOES_ATIVAS = frozenset(COMBINACOES[n] for n in _nomes_combinacoes) | {(True, True)}
+
+# Um conversor por combinação de opções, criado uma única vez por processo e reaproveitado
+# (modelos não são recarregados a cada request)
+@functools.lru_cache(maxsize=8)
+def _obter_conversor(com_vlm: bool, ocr: bool = True, tabelas: bool = True) -> "DocumentConverter":
+    options = PdfPipelineOptions()
+    
+    # Configurações básicas
+    options.do_ocr = ocr
+    options.do_table_structure = tabelas
+    options.table_structure_options.mode = TableFormerMode.FAST
+    options.generate_picture_images = True
+    options.images_scale = 1  # Resolução controlada
+    
+    if com_vlm:
+        # GRANITE VLM ATIVADO 🔥
+        options.do_picture_description = True
+        options.picture_description_options = granite_picture_description
+        if TORCH_COMPILE:
+            # KV cache estático: shapes fixos a cada passo do generate, então o modo
+            # reduce-overhead captura e reaproveita CUDA Graphs em vez de recompilar
+            options.picture_description_options = granite_picture_description.model_copy(update={
+                "generation_config": {**granite_picture_description.generation_config, "cache_implementation": "static"}
+            })
+    else:
+        options.do_picture_description = False  # SEM VLM
+    
+    return DocumentConverter(
+        format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=options)}
+    )
+
+# Pool de processos para as conversões (cada worker tem seus próprios conversores e roda
+# uma tarefa por vez, então não precisa de lock em volta dos modelos).
+# Cada worker carrega os próprios modelos na GPU: padrão 1, aumentar só se couber na VRAM
+N_WORKERS = int(os.getenv("DOCLING_WORKERS", "1"))
+_executor = None
+# Reaquecimento disparado quando o pool quebra (referência guardada para a task não ser coletada)
+_tarefa_reaquecimento = None
+# Backpressure: no máximo N_WORKERS conversões em andamento
+_semaforo = asyncio.Semaphore(N_WORKERS)
+_semaforo_lote = asyncio.Semaphore(MAX_LOTES)
+# Cliente HTTP compartilhado (criado no primeiro uso, fechado no shutdown)
+_http = None
+
+# Objetos de longa duração (modelos, FastAPI) vão para a geração permanente do GC
+# e os limiares sobem: o GC deixa de varrer os modelos a cada coleta
+def _congelar_heap():
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(50_000, 100, 100)
+
+# Limpeza periódica da pasta de imagens
+def _limpar_imagens_antigas():
+    limite = time.time() - IMAGES_TTL_MIN * 60
+    removidas = 0
+    with os.scandir(IMAGES_DIR) as it:
+        for entrada in it:
+            with contextlib.suppress(FileNotFoundError):
+                if entrada.stat().st_mtime < limite:
+                    os.unlink(entrada.path)
+                    removidas += 1
+    if removidas:
+        logger.info("🧹 %d imagens antigas removidas", removidas)
+
+async def _loop_limpeza_imagens():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await run_in_threadpool(_limpar_imagens_antigas)
+        except Exception as e:
+            logger.warning("⚠️ Erro na limpeza de imagens: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _congelar_heap()
+    limpeza = asyncio.create_task(_loop_limpeza_imagens())
+    aquecimento = asyncio.create_task(_aquecer_workers())
+    yield
+    aquecimento.cancel()
+    limpeza.cancel()
+    if _tarefa_reaquecimento is not None:
+        _tarefa_reaquecimento.cancel()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    if _http is not None:
+        await _http.aclose()
 
 # FastAPI
-app = FastAPI(title="Docling Granite API", version="1.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app = FastAPI(title="Docling Granite API", version="1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+# Sem credenciais: com origem "*" o CORS responde um header estático em vez de ecoar a Origin.
+# Em produção, CORS_ORIGINS com a lista de origens (separadas por vírgula)
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+app.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_credentials=False, allow_methods=["*"], allow_headers=["*"])
+# JSON com o texto extraído comprime bem; PNG/WEBP de /images já são comprimidos e passam direto
+class _GZipExcetoImagens:
+    def __init__(self, app, **opcoes):
+        self.app = app
+        self.gzip = GZipMiddleware(app, **opcoes)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/images/"):
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+app.add_middleware(_GZipExcetoImagens, minimum_size=1024)
 app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
 
+# Respostas fixas serializadas uma vez no import (sem jsonable_encoder a cada request)
+_CORPO_RAIZ = orjson.dumps({"status": "ok", "docling": DOCLING_OK, "modelo": "granite-vision", "porta": 9000})
+
 @app.get("/")
-def status():
-    return {"status": "ok", "docling": DOCLING_OK, "modelo": "granite-vision", "porta": 9000}
+async def status():
+    return _resposta_json(_CORPO_RAIZ)
+
+# Healthcheck (Docker/Render): resposta vazia, sem serializar nada
+@app.get("/health")
+async def health():
+    return Response(status_code=200)
+
+# Matriz de textos da tabela montada direto das células (sem o grid de TableCell do docling-core)
+_posicao_celula = operator.attrgetter('text', 'start_row_offset_idx', 'end_row_offset_idx',
+                                      'start_col_offset_idx', 'end_col_offset_idx')
+
+def _dados_tabela(tabela) -> List[List[str]]:
+    data = tabela.data
+    n_linhas, n_colunas = data.num_rows, data.num_cols
+    dados = [[""] * n_colunas for _ in range(n_linhas)]
+    for texto, l0, l1, c0, c1 in map(_posicao_celula, data.table_cells):
+        c0, c1 = min(c0, n_colunas), min(c1, n_colunas)
+        if c1 <= c0:
+            continue
+        # Células mescladas ocupam várias posições (atribuição por fatia, sem loop por coluna)
+        for linha in dados[l0:l1]:
+            linha[c0:c1] = [texto] * (c1 - c0)
+    return dados
+
+# Publica a imagem extraída em IMAGES_DIR. Sem checagens prévias (EAFP): quem chama trata
+# OSError/ValueError. PNG embutido (data URI) é gravado direto, sem reencode; arquivo vira
+# hardlink (O(1)) e só é copiado se estiver em outro filesystem
+def _salvar_imagem(uri, nome_arquivo: str) -> str:
+    caminho_destino = os.path.join(IMAGES_DIR, nome_arquivo)
+    origem = str(uri)
+    try:
+        if origem.startswith("data:"):
+            # Decodifica antes de criar o arquivo: base64 inválido não deixa arquivo vazio para trás
+            conteudo = base64.b64decode(origem.split(",", 1)[1])
+            with open(caminho_destino, 'xb') as f:
+                f.write(conteudo)
+        else:
+            origem = origem.removeprefix("file://")
+            try:
+                os.link(origem, caminho_destino)
+            except (FileExistsError, FileNotFoundError):
+                raise
+            except OSError:  # Outro filesystem (EXDEV) ou sem suporte a hardlink
+                shutil.copy(origem, caminho_destino)
+    except FileExistsError:
+        pass  # Mesmo documento (nome tem o hash do conteúdo), imagem já publicada
+    return f"/images/{nome_arquivo}"
+
+_texto = operator.attrgetter('text')
+
+# Reduz a imagem para caber em max_pixels (mantendo a proporção) e publica em WEBP
+def _salvar_imagem_reduzida(ref, nome_arquivo: str, max_pixels: int) -> str:
+    from PIL import Image
+    caminho_destino = os.path.join(IMAGES_DIR, nome_arquivo)
+    pil = ref.pil_image
+    if pil is None:
+        raise ValueError("imagem sem conteúdo")
+    escala = (max_pixels / (pil.width * pil.height)) ** 0.5
+    pil = pil.copy()
+    pil.thumbnail((max(1, int(pil.width * escala)), max(1, int(pil.height * escala))), Image.LANCZOS)
+    buf = BytesIO()
+    pil.save(buf, "WEBP", quality=80, method=4)
+    try:
+        with open(caminho_destino, 'xb') as f:
+            f.write(buf.getbuffer())
+    except FileExistsError:
+        pass
+    return f"/images/{nome_arquivo}"
+
+# Página do item via prov (1 quando não há proveniência)
+def _pagina(obj) -> int:
+    prov = getattr(obj, 'prov', None)
+    return prov[0].page_no if prov else 1
+
+# Monta a saída a partir das colunas (SoA). "colunar" devolve as colunas direto;
+# o padrão mantém a lista clássica de "elementos"
+def _montar_saida(paginas_textos: array, textos: List[str], paginas_tabelas: array, tabelas: List[List[List[str]]],
+                  imagens: List[Dict[str, Any]], colunar: bool) -> Dict[str, Any]:
+    if colunar:
+        return {
+            "textos": {"paginas": paginas_textos.tolist(), "conteudos": textos},
+            "tabelas": {"paginas": paginas_tabelas.tolist(), "dados": tabelas},
+            "imagens": imagens,
+        }
+    elementos = [{"tipo": "texto", "conteudo": t, "pagina": p} for p, t in zip(paginas_textos, textos)]
+    elementos.extend({"tipo": "tabela", "dados": d, "pagina": p} for p, d in zip(paginas_tabelas, tabelas))
+    elementos.extend({"tipo": "imagem", **img} for img in imagens)
+    return {"elementos": elementos}
+
+# Extração comum aos dois conversores; com_vlm lê as descrições do Granite nas imagens
+def _extrair(doc, id_doc: str, com_vlm: bool, colunar: bool, max_pixels: int = MAX_PIXELS_PADRAO):
+    # Extrair dados em colunas (páginas em array de 2 bytes em vez de int + dict por elemento)
+    paginas_textos, textos = array('H'), []
+    paginas_tabelas, tabelas = array('H'), []
+    imagens = []
+    descricoes_texto = []  # Descrições Granite que entram no texto completo
+    contador_granite = 0
+    prefixo_img = "granite_img" if com_vlm else "fallback_img"
+    # Logs por elemento só em DEBUG (evita formatar strings no loop quando desligado)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    
+    # TEXTOS
+    logger.info("📝 Processando textos...")
+    # Filtra uma vez e monta as duas colunas com map/extend (sem append por elemento)
+    validos = [t for t in doc.texts if t.text and not t.text.isspace()]
+    textos.extend(map(_texto, validos))
+    paginas_textos.extend(map(_pagina, validos))
+    del validos
+    
+    logger.info("✅ %d textos extraídos", len(textos))
+    
+    # TABELAS
+    logger.info("📊 Processando tabelas...")
+    for i, tabela in enumerate(doc.tables):
+        try:
+            pagina = _pagina(tabela)
+            
+            tabelas.append(_dados_tabela(tabela))
+            paginas_tabelas.append(pagina)
+            if debug:
+                logger.debug("Tabela %d processada", i + 1)
+        except Exception as e:
+            logger.warning("Erro na tabela %d: %s", i, e)
+    
+    logger.info("✅ %d tabelas extraídas", len(tabelas))
+    
+    # IMAGENS (COM GRANITE VLM 🎯 quando ativo)
+    total_pics = len(doc.pictures)
+    logger.info("📷 Total de imagens encontradas: %d", total_pics)
+    
+    for i, img in enumerate(doc.pictures):
+        pagina = 1
+        try:
+            if debug:
+                logger.debug("🔍 Analisando imagem %d/%d...", i + 1, total_pics)
+            
+            pagina = _pagina(img)
+            
+            # Salvar imagem
+            try:
+                tamanho = img.image.size
+                if max_pixels and tamanho.width * tamanho.height > max_pixels:
+                    nome_arquivo = f"{prefixo_img}_{id_doc}_p{pagina}_{i}_m{max_pixels}.webp"
+                    img_url = _salvar_imagem_reduzida(img.image, nome_arquivo, max_pixels)
+                else:
+                    nome_arquivo = f"{prefixo_img}_{id_doc}_p{pagina}_{i}.png"
+                    img_url = _salvar_imagem(img.image.uri, nome_arquivo)
+                if debug:
+                    logger.debug("🖼️ Imagem %d salva: %s", i + 1, nome_arquivo)
+            except (OSError, AttributeError, ValueError):
+                img_url = None
+                logger.warning("⚠️ Imagem %d - URI inválida ou arquivo não existe", i + 1)
+            
+            # EXTRAIR DESCRIÇÕES GRANITE 🔥
+            descricoes_granite = []
+            anotacoes = getattr(img, 'annotations', None) if com_vlm else None
+            
+            if anotacoes:
+                if debug:
+                    logger.debug("📝 Imagem %d tem %d anotações", i + 1, len(anotacoes))
+                
+                for j, annotation in enumerate(anotacoes):
+                    try:
+                        # Verificar propriedades da anotação
+                        ann_kind = getattr(annotation, 'kind', None)
+                        ann_text = getattr(annotation, 'text', None)
+                        
+                        if debug:
+                            logger.debug("   Anotação %d: kind='%s', text_len=%d", j + 1, ann_kind, len(str(ann_text)) if ann_text else 0)
+                        
+                        # Verificar se é descrição do Granite
+                        if ann_kind == 'description' and ann_text and str(ann_text).strip():
+                            desc_text = str(ann_text).strip()
+                            
+                            descricoes_granite.append({
+                                "texto": desc_text,
+                                "modelo": "granite-vision",
+                                "confianca": "alta"
+                            })
+                            contador_granite += 1
+                            
+                            # Adicionar ao texto completo
+                            descricoes_texto.append(f"[Granite Vision - Página {pagina}, Imagem {i+1}]: {desc_text}")
+                            
+                            if debug:
+                                logger.debug("✅ Granite descrição %d: %s...", j + 1, desc_text[:100])
+                        elif debug:
+                            logger.debug("   ⏭️ Anotação %d ignorada (não é descrição Granite)", j + 1)
+                            
+                    except Exception as e:
+                        logger.warning("Erro processando anotação %d: %s", j, e)
+            elif com_vlm and debug:
+                logger.debug("📝 Imagem %d não tem anotações", i + 1)
+            
+            # Elemento da imagem
+            imagens.append({
+                "url": img_url,
+                "legenda": getattr(img, "caption", "") or "",
+                "descricoes_granite": descricoes_granite,
+                "pagina": pagina,
+                "total_descricoes": len(descricoes_granite)
+            })
+            
+            if debug:
+                logger.debug("✅ Imagem %d processada com %d descrições Granite", i + 1, len(descricoes_granite))
+            
+        except Exception as e:
+            logger.error("❌ Erro processando imagem %d: %s", i, e)
+            # Adicionar imagem sem descrição se der erro
+            imagens.append({
+                "url": None,
+                "legenda": "",
+                "descricoes_granite": [],
+                "pagina": pagina,
+                "erro": str(e)
+            })
+    
+    saida = _montar_saida(paginas_textos, textos, paginas_tabelas, tabelas, imagens, colunar)
+    texto = "\n".join(chain(textos, descricoes_texto))
+    return saida, texto, (len(textos), len(tabelas), len(imagens), contador_granite)
 
 # Função COMPLETA com Granite VLM
-def processar_documento_granite(arquivo_path: str) -> Dict[str, Any]:
+def processar_documento_granite(fonte: Union[str, "DocumentStream"], id_doc: str = "doc", colunar: bool = False,
+                                ocr: bool = True, tabelas: bool = True,
+                                max_pixels: int = MAX_PIXELS_PADRAO) -> Dict[str, Any]:
     if not DOCLING_OK:
         raise HTTPException(status_code=500, detail="Docling não disponível")
     
     try:
         logger.info("🔥 Processando com GRANITE VLM ativado...")
         
-        # Limpar memória antes de começar
-        gc.collect()
-        
-        # Configuração OTIMIZADA para Granite
-        options = PdfPipelineOptions()
-        
-        # Configurações básicas
-        options.do_ocr = True
-        options.do_table_structure = True
-        options.generate_picture_images = True
-        options.images_scale = 1  # Resolução controlada
-        
-        # GRANITE VLM ATIVADO 🔥
-        options.do_picture_description = True
-        options.picture_description_options = granite_picture_description
-        
-        logger.info("✅ Granite Vision configurado!")
-        logger.info(f"   - OCR: {options.do_ocr}")
-        logger.info(f"   - Tabelas: {options.do_table_structure}")
-        logger.info(f"   - Imagens: {options.generate_picture_images}")
-        logger.info(f"   - Granite VLM: {options.do_picture_description}")
-        logger.info(f"   - Escala: {options.images_scale}")
-        
-        # Converter
-        converter = DocumentConverter(
-            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=options)}
-        )
-        
         logger.info("🔄 Executando conversão com Granite...")
-        resultado = converter.convert(arquivo_path)
+        resultado = _obter_conversor(True, ocr, tabelas).convert(fonte)
         logger.info("✅ Conversão Granite concluída!")
         
-        doc = resultado.document
-        
-        # Extrair dados
-        elementos = []
-        texto_completo = []
-        contador_granite = 0
-        
-        # TEXTOS
-        logger.info("📝 Processando textos...")
-        for i, texto in enumerate(doc.texts):
-            if texto.text and texto.text.strip():
-                # Página via prov
-                pagina = 1
-                if hasattr(texto, 'prov') and texto.prov and len(texto.prov) > 0:
-                    pagina = texto.prov[0].page_no
-                
-                elementos.append({
-                    "tipo": "texto",
-                    "conteudo": texto.text,
-                    "pagina": pagina
-                })
-                texto_completo.append(texto.text)
-                
-                if i % 50 == 0:
-                    logger.info(f"Processados {i} textos...")
-        
-        logger.info(f"✅ {len([e for e in elementos if e['tipo'] == 'texto'])} textos extraídos")
-        
-        # TABELAS
-        logger.info("📊 Processando tabelas...")
-        for i, tabela in enumerate(doc.tables):
-            try:
-                pagina = 1
-                if hasattr(tabela, 'prov') and tabela.prov and len(tabela.prov) > 0:
-                    pagina = tabela.prov[0].page_no
-                
-                elementos.append({
-                    "tipo": "tabela",
-                    "dados": [[getattr(cell, 'text', str(cell)) for cell in row] for row in tabela.data],
-                    "pagina": pagina
-                })
-                logger.info(f"Tabela {i+1} processada")
-            except Exception as e:
-                logger.warning(f"Erro na tabela {i}: {e}")
-        
-        # IMAGENS COM GRANITE VLM 🎯
-        logger.info("🖼️ Processando imagens com Granite Vision...")
-        
-        # Debug: total de imagens
-        total_pics = len(doc.pictures)
-        logger.info(f"📷 Total de imagens encontradas: {total_pics}")
-        
-        for i, img in enumerate(doc.pictures):
-            try:
-                logger.info(f"🔍 Analisando imagem {i+1}/{total_pics}...")
-                
-                # Página via prov
-                pagina = 1
-                if hasattr(img, 'prov') and img.prov and len(img.prov) > 0:
-                    pagina = img.prov[0].page_no
-                
-                # Salvar imagem
-                img_url = None
-                if img.image and hasattr(img.image, 'uri') and img.image.uri and os.path.exists(img.image.uri):
-                    nome_arquivo = f"granite_img_p{pagina}_{i}.png"
-                    caminho_destino = os.path.join(IMAGES_DIR, nome_arquivo)
-                    shutil.copy(img.image.uri, caminho_destino)
-                    img_url = f"/images/{nome_arquivo}"
-                    logger.info(f"🖼️ Imagem {i+1} salva: {nome_arquivo}")
-                else:
-                    logger.warning(f"⚠️ Imagem {i+1} - URI inválida ou arquivo não existe")
-                
-                # EXTRAIR DESCRIÇÕES GRANITE 🔥
-                descricoes_granite = []
-                
-                # Debug das anotações
-                if hasattr(img, 'annotations'):
-                    if img.annotations and len(img.annotations) > 0:
-                        logger.info(f"📝 Imagem {i+1} tem {len(img.annotations)} anotações")
-                        
-                        for j, annotation in enumerate(img.annotations):
-                            try:
-                                # Verificar propriedades da anotação
-                                ann_kind = getattr(annotation, 'kind', None)
-                                ann_text = getattr(annotation, 'text', None)
-                                
-                                logger.info(f"   Anotação {j+1}: kind='{ann_kind}', text_len={len(str(ann_text)) if ann_text else 0}")
-                                
-                                # Verificar se é descrição do Granite
-                                if ann_kind == 'description' and ann_text and str(ann_text).strip():
-                                    desc_text = str(ann_text).strip()
-                                    
-                                    descricoes_granite.append({
-                                        "texto": desc_text,
-                                        "modelo": "granite-vision",
-                                        "confianca": "alta"
-                                    })
-                                    contador_granite += 1
-                                    
-                                    # Adicionar ao texto completo
-                                    texto_completo.append(f"[Granite Vision - Página {pagina}, Imagem {i+1}]: {desc_text}")
-                                    
-                                    logger.info(f"✅ Granite descrição {j+1}: {desc_text[:100]}...")
-                                else:
-                                    logger.info(f"   ⏭️ Anotação {j+1} ignorada (não é descrição Granite)")
-                                    
-                            except Exception as e:
-                                logger.warning(f"Erro processando anotação {j}: {e}")
-                    else:
-                        logger.info(f"📝 Imagem {i+1} não tem anotações")
-                else:
-                    logger.info(f"📝 Imagem {i+1} não tem atributo 'annotations'")
-                
-                # Elemento da imagem
-                elementos.append({
-                    "tipo": "imagem",
-                    "url": img_url,
-                    "legenda": getattr(img, "caption", "") or "",
-                    "descricoes_granite": descricoes_granite,
-                    "pagina": pagina,
-                    "total_descricoes": len(descricoes_granite)
-                })
-                
-                logger.info(f"✅ Imagem {i+1} processada com {len(descricoes_granite)} descrições Granite")
-                
-            except Exception as e:
-                logger.error(f"❌ Erro processando imagem {i}: {e}")
-                # Adicionar imagem sem descrição se der erro
-                elementos.append({
-                    "tipo": "imagem",
-                    "url": None,
-                    "legenda": "",
-                    "descricoes_granite": [],
-                    "pagina": pagina if 'pagina' in locals() else 1,
-                    "erro": str(e)
-                })
-        
-        # Texto final
-        total_texto = "\n".join(texto_completo)
-        
-        if not total_texto.strip():
-            total_texto = "Nenhum texto foi extraído do documento."
-            logger.warning("⚠️ Nenhum texto extraído")
-        
-        # Estatísticas detalhadas
-        total_textos = len([e for e in elementos if e['tipo'] == 'texto'])
-        total_tabelas = len([e for e in elementos if e['tipo'] == 'tabela'])
-        total_imagens = len([e for e in elementos if e['tipo'] == 'imagem'])
-        
-        # Resultado final
-        resultado_final = {
-            "elementos": elementos,
-            "texto": total_texto,
-            "resumo": {
-                "total_elementos": len(elementos),
-                "total_textos": total_textos,
-                "total_tabelas": total_tabelas,
-                "total_imagens": total_imagens,
-                "descricoes_granite": contador_granite,
-                "modelo": "granite-vision",
-                "status": "sucesso_com_granite",
-                "granite_ativo": True,
-                "taxa_sucesso": f"{contador_granite}/{total_imagens}" if total_imagens > 0 else "0/0"
-            }
-        }
-        
-        logger.info(f"🎯 GRANITE SUCESSO TOTAL: {contador_granite} descrições geradas!")
-        logger.info(f"📊 Elementos: {len(elementos)} | Imagens: {total_imagens}")
-        logger.info(f"🔥 Taxa Granite: {contador_granite}/{total_imagens}")
-        
-        return resultado_final
+        return _resultado_granite(resultado.document, id_doc, colunar, max_pixels)
         
     except Exception as e:
-        logger.error(f"❌ ERRO no processamento Granite: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+        # Traceback só é formatado se o registro passar pelo filtro de repetidos
+        logger.exception("❌ ERRO no processamento Granite: %s", e)
         
         # Tentar fallback sem VLM se for erro de memória
         if "buffer size" in str(e).lower() or "memory" in str(e).lower():
             logger.warning("🔄 Erro de memória detectado, tentando fallback sem VLM...")
-            return processar_documento_fallback(arquivo_path)
+            # Stream em memória já foi consumido pela primeira tentativa
+            if isinstance(fonte, DocumentStream):
+                fonte.stream.seek(0)
+            return processar_documento_fallback(fonte, id_doc, colunar, ocr, tabelas, max_pixels)
         else:
             raise HTTPException(status_code=500, detail=f"Erro Granite: {str(e)}")
 
+# Resultado final de um documento já convertido com Granite (usado também pelo lote)
+def _resultado_granite(documento, id_doc: str, colunar: bool, max_pixels: int) -> Dict[str, Any]:
+    saida, total_texto, (total_textos, total_tabelas, total_imagens, contador_granite) = _extrair(
+        documento, id_doc, com_vlm=True, colunar=colunar, max_pixels=max_pixels
+    )
+    
+    if not total_texto.strip():
+        total_texto = "Nenhum texto foi extraído do documento."
+        logger.warning("⚠️ Nenhum texto extraído")
+    
+    # Estatísticas detalhadas
+    total_elementos = total_textos + total_tabelas + total_imagens
+    
+    # Resultado final
+    resultado_final = {
+        **saida,
+        "texto": total_texto,
+        "resumo": {
+            "total_elementos": total_elementos,
+            "total_textos": total_textos,
+            "total_tabelas": total_tabelas,
+            "total_imagens": total_imagens,
+            "descricoes_granite": contador_granite,
+            "modelo": "granite-vision",
+            "status": "sucesso_com_granite",
+            "granite_ativo": True,
+            "taxa_sucesso": f"{contador_granite}/{total_imagens}" if total_imagens > 0 else "0/0"
+        }
+    }
+    
+    logger.info("🎯 GRANITE SUCESSO TOTAL: %d descrições geradas!", contador_granite)
+    logger.info("📊 Elementos: %d | Imagens: %d", total_elementos, total_imagens)
+    logger.info("🔥 Taxa Granite: %d/%d", contador_granite, total_imagens)
+    
+    return resultado_final
+
 # Função FALLBACK sem VLM
-def processar_documento_fallback(arquivo_path: str) -> Dict[str, Any]:
+def processar_documento_fallback(fonte: Union[str, "DocumentStream"], id_doc: str = "doc", colunar: bool = False,
+                                 ocr: bool = True, tabelas: bool = True,
+                                 max_pixels: int = MAX_PIXELS_PADRAO) -> Dict[str, Any]:
     try:
         logger.info("⚠️ Executando fallback SEM VLM...")
         
-        # Configuração mínima sem VLM
-        options = PdfPipelineOptions()
-        options.do_ocr = True
-        options.do_table_structure = True
-        options.generate_picture_images = True
-        options.images_scale = 1
-        options.do_picture_description = False  # SEM VLM
-        
-        converter = DocumentConverter(
-            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=options)}
-        )
-        
-        resultado = converter.convert(arquivo_path)
-        doc = resultado.document
+        # Conversor sem VLM (já carregado no startup do worker)
+        resultado = _obter_conversor(False, ocr, tabelas).convert(fonte)
         
         # Mesmo processamento mas sem descrições VLM
-        elementos = []
-        texto_completo = []
-        
-        # Textos
-        for texto in doc.texts:
-            if texto.text and texto.text.strip():
-                pagina = 1
-                if hasattr(texto, 'prov') and texto.prov and len(texto.prov) > 0:
-                    pagina = texto.prov[0].page_no
-                
-                elementos.append({
-                    "tipo": "texto",
-                    "conteudo": texto.text,
-                    "pagina": pagina
-                })
-                texto_completo.append(texto.text)
-        
-        # Tabelas
-        for tabela in doc.tables:
-            try:
-                pagina = 1
-                if hasattr(tabela, 'prov') and tabela.prov and len(tabela.prov) > 0:
-                    pagina = tabela.prov[0].page_no
-                
-                elementos.append({
-                    "tipo": "tabela",
-                    "dados": [[getattr(cell, 'text', str(cell)) for cell in row] for row in tabela.data],
-                    "pagina": pagina
-                })
-            except:
-                pass
-        
-        # Imagens sem descrições
-        for i, img in enumerate(doc.pictures):
-            try:
-                pagina = 1
-                if hasattr(img, 'prov') and img.prov and len(img.prov) > 0:
-                    pagina = img.prov[0].page_no
-                
-                img_url = None
-                if img.image and hasattr(img.image, 'uri') and img.image.uri and os.path.exists(img.image.uri):
-                    nome_arquivo = f"fallback_img_p{pagina}_{i}.png"
-                    caminho_destino = os.path.join(IMAGES_DIR, nome_arquivo)
-                    shutil.copy(img.image.uri, caminho_destino)
-                    img_url = f"/images/{nome_arquivo}"
-                
-                elementos.append({
-                    "tipo": "imagem",
-                    "url": img_url,
-                    "legenda": getattr(img, "caption", "") or "",
-                    "descricoes_granite": [],  # Vazio no fallback
-                    "pagina": pagina
-                })
-            except:
-                pass
+        saida, texto, (total_textos, total_tabelas, total_imagens, _) = _extrair(
+            resultado.document, id_doc, com_vlm=False, colunar=colunar, max_pixels=max_pixels
+        )
         
         return {
-            "elementos": elementos,
-            "texto": "\n".join(texto_completo),
+            **saida,
+            "texto": texto,
             "resumo": {
-                "total_elementos": len(elementos),
+                "total_elementos": total_textos + total_tabelas + total_imagens,
                 "descricoes_granite": 0,
                 "modelo": "fallback-sem-vlm",
                 "status": "sucesso_fallback"
@@ -346,113 +574,798 @@ def processar_documento_fallback(arquivo_path: str) -> Dict[str, Any]:
         }
         
     except Exception as e:
-        logger.error(f"❌ Erro até no fallback: {e}")
-        return {
-            "elementos": [],
-            "texto": f"Erro crítico: {str(e)}",
-            "resumo": {
-                "total_elementos": 0,
-                "descricoes_granite": 0,
-                "modelo": "erro",
-                "status": "falha_total"
-            }
-        }
+        logger.error("❌ Erro até no fallback: %s", e)
+        return _resultado_falha(colunar, f"Erro crítico: {str(e)}")
+
+# Resposta de documento que não pôde ser processado: modelos montados uma vez (um por layout),
+# por chamada só entra a mensagem. As partes internas são compartilhadas, não alterar
+_RESUMO_FALHA = {
+    "total_elementos": 0,
+    "descricoes_granite": 0,
+    "modelo": "erro",
+    "status": "falha_total"
+}
+_MODELOS_FALHA = {
+    colunar: _montar_saida(array('H'), [], array('H'), [], [], colunar) for colunar in (False, True)
+}
+
+def _resultado_falha(colunar: bool, mensagem: str) -> Dict[str, Any]:
+    return {**_MODELOS_FALHA[colunar], "texto": mensagem, "resumo": _RESUMO_FALHA}
+
+# WORKERS DE CONVERSÃO
+class ErroProcessamento(Exception):
+    pass
+
+# Etapa de enriquecimento que segura o modelo Granite Vision (processor + model do HF)
+def _etapa_granite(ocr: bool = True, tabelas: bool = True):
+    for pipeline in _obter_conversor(True, ocr, tabelas).initialized_pipelines.values():
+        for etapa in getattr(pipeline, 'enrichment_pipe', []):
+            if getattr(etapa, 'model', None) is not None and hasattr(etapa, 'processor'):
+                return etapa
+    return None
+
+# PDF de 1 página com uma imagem, usado para pagar o custo de compilação no startup
+def _pdf_aquecimento() -> "DocumentStream":
+    from PIL import Image
+    buf = BytesIO()
+    Image.effect_noise((512, 512), 64).convert("RGB").save(buf, "PDF")
+    buf.seek(0)
+    return DocumentStream(name="aquecimento.pdf", stream=buf)
+
+def _compilar_granite(ocr: bool = True, tabelas: bool = True):
+    etapa = _etapa_granite(ocr, tabelas)
+    if etapa is None:
+        logger.warning("⚠️ Modelo Granite não encontrado, torch.compile ignorado")
+        return
+    etapa.model.forward = torch.compile(etapa.model.forward, mode="reduce-overhead", fullgraph=False)
+    logger.info("🧪 Compilando Granite (aquecimento)...")
+    _obter_conversor(True, ocr, tabelas).convert(_pdf_aquecimento())
+    logger.info("✅ Granite compilado")
+
+def _inicializar_worker():
+    # Carrega (e compila) o Granite de cada combinação habilitada antes da primeira conversão.
+    # O conversor sem VLM também: o fallback roda justamente sob pressão de memória,
+    # não é hora de carregar layout/TableFormer/EasyOCR do zero
+    if DOCLING_OK:
+        for ocr, tabelas in sorted(COMBINACOES_ATIVAS, reverse=True):
+            _obter_conversor(True, ocr, tabelas).initialize_pipeline(InputFormat.PDF)
+            _obter_conversor(False, ocr, tabelas).initialize_pipeline(InputFormat.PDF)
+            if TORCH_COMPILE:
+                try:
+                    _compilar_granite(ocr, tabelas)
+                except Exception as e:
+                    logger.warning("⚠️ torch.compile falhou (ocr=%s, tabelas=%s), seguindo sem compilar: %s", ocr, tabelas, e)
+        logger.info("✅ Granite Vision configurado! (OCR, tabelas, imagens, escala 1)")
+    _congelar_heap()
+    logger.info("👷 Worker %d pronto", os.getpid())
+
+def _obter_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: CUDA não funciona em processos criados via fork
+        _executor = ProcessPoolExecutor(
+            max_workers=N_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_inicializar_worker,
+        )
+    return _executor
+
+# Roda no pool de conversão. Worker morto (OOM killer, crash em código nativo) quebra o pool inteiro:
+# descarta o pool para o próximo request subir um novo e responde 503 para este
+async def _executar_no_pool(funcao, *args):
+    global _executor, _tarefa_reaquecimento
+    executor = _obter_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, funcao, *args)
+    except BrokenProcessPool:
+        logger.error("💥 Worker de conversão morreu, recriando o pool")
+        if _executor is executor:
+            _executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            _tarefa_reaquecimento = asyncio.create_task(_aquecer_workers())
+        raise HTTPException(status_code=503, detail="Worker de conversão reiniciando, tente novamente")
+
+# Sobe os N_WORKERS processos (e carrega os modelos) no startup, não no primeiro request.
+# Roda em background para o /health responder enquanto os modelos carregam
+async def _aquecer_workers():
+    if not DOCLING_OK:
+        return
+    loop = asyncio.get_running_loop()
+    executor = _obter_executor()
+    inicio = time.monotonic()
+    try:
+        # Sem worker ocioso, cada submit cria um processo novo (até max_workers)
+        pids = await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(N_WORKERS)))
+        logger.info("🔥 %d workers de conversão prontos em %.1fs", len(set(pids)), time.monotonic() - inicio)
+    except Exception as e:
+        logger.warning("⚠️ Aquecimento dos workers falhou: %s", e)
+
+# PDF já tem camada de texto em todas as páginas? Lê com o pdfium (~1ms por página, sem modelos).
+# Uma página escaneada no meio já basta para manter o OCR
+def _pdf_tem_texto(fonte: Union[str, "DocumentStream"]) -> bool:
+    if not PDFIUM_OK:
+        return False
+    origem = fonte if isinstance(fonte, str) else fonte.stream
+    try:
+        pdf = pdfium.PdfDocument(origem)
+        try:
+            if len(pdf) == 0:
+                return False
+            for i in range(len(pdf)):
+                pagina = pdf[i]
+                texto = pagina.get_textpage()
+                chars = len(texto.get_text_bounded().strip())
+                texto.close()
+                pagina.close()
+                if chars < MIN_CHARS_POR_PAGINA:
+                    return False
+            return True
+        finally:
+            pdf.close()
+    except Exception as e:
+        logger.warning("⚠️ Não deu para checar a camada de texto: %s", e)
+        return False
+    finally:
+        if not isinstance(fonte, str):
+            fonte.stream.seek(0)
+
+# OCR pedido mas desnecessário (PDF digital)? Só troca quando a combinação sem OCR está habilitada
+# (e portanto já carregada no worker); senão segue com o conversor pedido
+def _ocr_efetivo(fonte: Union[str, "DocumentStream"], ocr: bool, tabelas: bool) -> bool:
+    if ocr and (False, tabelas) in COMBINACOES_ATIVAS and _pdf_tem_texto(fonte):
+        logger.info("📝 PDF com camada de texto, OCR desligado")
+        return False
+    return ocr
+
+# Devolve (corpo JSON/NDJSON, status, imagens): o corpo é montado aqui no worker, e só bytes voltam pelo pickle
+def _processar_em_worker(fonte: Union[str, "DocumentStream"], id_doc: str, colunar: bool,
+                         ocr: bool, tabelas: bool, max_pixels: int) -> tuple:
+    # PDF digital: o texto vem da camada do PDF, OCR só gastaria tempo
+    ocr = _ocr_efetivo(fonte, ocr, tabelas)
+    # HTTPException não sobrevive ao pickle entre processos
+    try:
+        resultado = processar_documento_granite(fonte, id_doc, colunar, ocr, tabelas, max_pixels)
+    except HTTPException as e:
+        raise ErroProcessamento(e.detail) from None
+    return _serializar(resultado), resultado["resumo"]["status"], _imagens_resultado(resultado)
+
+# Lote inteiro num só worker: convert_all reaproveita o conversor aquecido e mantém a GPU ocupada
+# entre um documento e outro. Devolve (corpo, status, imagens) por documento, na ordem recebida
+def _processar_lote_em_worker(fontes: List[Union[str, "DocumentStream"]], ids: List[str], colunar: bool,
+                              ocr: bool, tabelas: bool, max_pixels: int) -> List[tuple]:
+    # Um convert_all por configuração de OCR (PDFs digitais pulam o OCR, como no /convert)
+    ocr_por_fonte = [_ocr_efetivo(f, ocr, tabelas) for f in fontes]
+    saidas = [None] * len(fontes)
+    for ocr_grupo in (True, False):
+        indices = [i for i, o in enumerate(ocr_por_fonte) if o == ocr_grupo]
+        if not indices:
+            continue
+        logger.info("📚 Lote: %d documentos (OCR %s)", len(indices), 'ligado' if ocr_grupo else 'desligado')
+        falhas = []
+        conversoes = _obter_conversor(True, ocr_grupo, tabelas).convert_all(
+            [fontes[i] for i in indices], raises_on_error=False
+        )
+        for i, conversao in zip(indices, conversoes):
+            try:
+                if conversao.status not in (ConversionStatus.SUCCESS, ConversionStatus.PARTIAL_SUCCESS):
+                    raise RuntimeError(f"conversão terminou com status {conversao.status.value}")
+                resultado = _resultado_granite(conversao.document, ids[i], colunar, max_pixels)
+            except Exception as e:
+                logger.error("❌ Erro no documento %d do lote: %s", i + 1, e)
+                falhas.append(i)
+                continue
+            saidas[i] = (_serializar(resultado), resultado["resumo"]["status"], _imagens_resultado(resultado))
+        # Documentos que falharam no Granite vão para o fallback sem VLM, um a um, depois que o
+        # convert_all terminou. Diferente do /convert (fallback só em erro de memória), aqui vale
+        # para qualquer falha: o lote não tem como devolver 500 para um documento só
+        for i in falhas:
+            if isinstance(fontes[i], DocumentStream):
+                fontes[i].stream.seek(0)
+            resultado = processar_documento_fallback(fontes[i], ids[i], colunar, ocr_grupo, tabelas, max_pixels)
+            saidas[i] = (_serializar(resultado), resultado["resumo"]["status"], _imagens_resultado(resultado))
+    return saidas
+
+# Copia o upload em blocos direto para o arquivo temporário (calculando o hash) e devolve o tamanho em bytes
+# Para assim que passar de `limite` bytes (o chamador rejeita o arquivo)
+def _copiar_upload(origem, destino, hasher, inicio: bytes = b"", limite: int = MAX_UPLOAD_MB * 1024 * 1024) -> int:
+    destino.write(inicio)
+    hasher.update(inicio)
+    # Spool do Starlette já foi para o disco: cópia dentro do kernel (sendfile), sem passar por bytes
+    if getattr(origem, "_rolled", False) and hasattr(os, "sendfile"):
+        return _copiar_upload_sendfile(origem, destino, hasher, len(inicio), limite)
+    while bloco := origem.read(CHUNK_UPLOAD):
+        destino.write(bloco)
+        hasher.update(bloco)
+        if destino.tell() > limite:
+            break
+    return destino.tell()
+
+def _copiar_upload_sendfile(origem, destino, hasher, ja_escrito: int, limite: int) -> int:
+    destino.flush()
+    fd_origem, fd_destino = origem.fileno(), destino.fileno()
+    posicao = origem.tell()
+    restante = limite + 1 - ja_escrito  # um byte a mais para o chamador saber que passou do limite
+    while restante > 0:
+        enviados = os.sendfile(fd_destino, fd_origem, posicao, restante)
+        if enviados == 0:
+            break
+        posicao += enviados
+        restante -= enviados
+    origem.seek(posicao)
+    tamanho = destino.seek(0, os.SEEK_END)
+    
+    # Hash direto das páginas do arquivo de destino (page cache), sem cópia para o Python
+    if tamanho > ja_escrito:
+        with mmap.mmap(fd_destino, tamanho, access=mmap.ACCESS_READ) as mapa:
+            with memoryview(mapa) as vista, vista[ja_escrito:] as resto:
+                hasher.update(resto)
+    return tamanho
+
+# Copia o upload para um temporário novo em `diretorio`; em erro (ex.: ENOSPC) não deixa arquivo pela metade
+def _copiar_para_temp(origem, hasher, inicio: bytes, diretorio: str):
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf', dir=diretorio)
+    try:
+        with tmp:
+            tamanho = _copiar_upload(origem, tmp, hasher, inicio)
+    except BaseException:
+        _remover_temp(tmp.name)
+        raise
+    return tmp.name, tamanho
+
+def _erro_tamanho(tamanho: int, exato: bool = True) -> HTTPException:
+    tamanho_mb = tamanho / (1024 * 1024)
+    descricao = f"{tamanho_mb:.1f}MB" if exato else f"mais de {MAX_UPLOAD_MB}MB"
+    return HTTPException(status_code=400, detail=f"Arquivo muito grande para Granite: {descricao}. Máximo: {MAX_UPLOAD_MB}MB")
+
+# CACHE POR HASH DO CONTEÚDO
+def _chave_cache(hash_conteudo: str, colunar: bool, ocr: bool, tabelas: bool, max_pixels: int) -> str:
+    layout = "colunar" if colunar else "elementos"
+    opcoes = f"{ASSINATURA_OPCOES}|{layout}|ocr={ocr}|tabelas={tabelas}|max_pixels={max_pixels}"
+    return hashlib.sha256(f"{hash_conteudo}|{opcoes}".encode()).hexdigest()
+
+# Nomes dos arquivos de imagem de um resultado, em qualquer layout
+def _imagens_resultado(resultado: Dict[str, Any]) -> List[str]:
+    if "imagens" in resultado:
+        imagens = resultado["imagens"]
+    else:
+        imagens = (e for e in resultado["elementos"] if e["tipo"] == "imagem")
+    return [os.path.basename(img["url"]) for img in imagens if img.get("url")]
+
+# Resultado já serializado: o corpo vai direto para o cliente, sem passar por dict
+_OPCOES_ORJSON = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def _serializar(resultado: Dict[str, Any]) -> bytes:
+    return orjson.dumps(resultado, option=_OPCOES_ORJSON)
+
+def _resposta_json(corpo: bytes) -> Response:
+    return Response(content=corpo, media_type="application/json")
+
+# Entrada do cache: 1ª linha com a lista de imagens (JSON), depois o corpo da resposta.
+# orjson nunca emite quebra de linha literal, então a 1ª linha é sempre o cabeçalho
+def _ler_cache(chave: str) -> Optional[bytes]:
+    caminho = os.path.join(CACHE_DIR, f"{chave}.json")
+    try:
+        with open(caminho, 'rb') as f:
+            imagens = orjson.loads(f.readline())
+            corpo = f.read()
+        # Imagens do resultado podem ter sido limpas: renova o TTL ou trata como miss
+        for nome in imagens:
+            os.utime(os.path.join(IMAGES_DIR, nome))
+        os.utime(caminho)  # Marca como usado recentemente (LRU)
+        return corpo
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("⚠️ Cache inválido %s: %s", chave, e)
+        return None
+
+def _gravar_cache(chave: str, corpo: bytes, imagens: List[str]):
+    caminho = os.path.join(CACHE_DIR, f"{chave}.json")
+    try:
+        # Escrita atômica: arquivo temporário + rename
+        temp = f"{caminho}.{os.getpid()}.tmp"
+        with open(temp, 'wb') as f:
+            f.write(orjson.dumps(imagens))
+            f.write(b"\n")
+            f.write(corpo)
+        os.replace(temp, caminho)
+        _podar_cache()
+    except Exception as e:
+        logger.warning("⚠️ Erro gravando cache %s: %s", chave, e)
+
+# Remove as entradas menos usadas (por atime) até caber em CACHE_MAX_MB.
+# Inclui o índice de URLs (conta o espaço ocupado em disco: cada arquivo pequeno gasta um bloco)
+def _podar_cache():
+    entradas = []
+    total = 0
+    for pasta, sufixo in ((CACHE_DIR, '.json'), (URLS_DIR, '')):
+        with os.scandir(pasta) as it:
+            for entrada in it:
+                if entrada.is_file() and entrada.name.endswith(sufixo) and not entrada.name.endswith('.tmp'):
+                    st = entrada.stat()
+                    tamanho = max(st.st_size, st.st_blocks * 512)
+                    entradas.append((st.st_atime, tamanho, entrada.path))
+                    total += tamanho
+    
+    limite = CACHE_MAX_MB * 1024 * 1024
+    if total <= limite:
+        return
+    
+    entradas.sort()
+    for _, tamanho, caminho in entradas:
+        if total <= limite:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(caminho)
+        total -= tamanho
+    logger.info("🧹 Cache podado para %.1fMB", total / (1024 * 1024))
+
+def _remover_temp(caminho: str):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(caminho)
+        logger.info("🗑️ Arquivo temporário removido")
+
+# Validações baratas do upload (extensão, tamanho declarado, assinatura) antes de copiar qualquer coisa
+async def _validar_pdf(file: UploadFile):
+    if os.path.splitext(file.filename)[1].lower() not in EXTENSOES_ACEITAS:
+        raise HTTPException(status_code=400, detail="Apenas arquivos PDF são aceitos")
+    
+    # Tamanho já conhecido pelo multipart: rejeita sem ler nada
+    if file.size is not None and file.size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise _erro_tamanho(file.size)
+    
+    # Assinatura do PDF nos primeiros bytes: rejeita antes de copiar qualquer coisa
+    cabecalho = await file.read(8)
+    if not cabecalho.startswith(b'%PDF-'):
+        raise HTTPException(status_code=400, detail="Arquivo não é um PDF válido")
+    await file.seek(0)
+
+# Recebe o PDF e devolve (fonte para o Docling, arquivo temporário ou None, hash do conteúdo)
+async def _receber_pdf(file: UploadFile):
+    # PDFs pequenos ficam em memória; os maiores vão para um arquivo temporário (streaming, fora do event loop)
+    limiar = FILE_SIZE_MB_THRESHOLD * 1024 * 1024
+    hasher = hashlib.sha256()
+    arquivo_temp = None
+    inicio = await file.read(limiar + 1)
+    try:
+        if len(inicio) <= limiar:
+            tamanho = len(inicio)
+            hasher.update(inicio)
+            fonte = DocumentStream(name=file.filename, stream=BytesIO(inicio))
+        else:
+            try:
+                arquivo_temp, tamanho = await run_in_threadpool(_copiar_para_temp, file.file, hasher, inicio, TMP_DIR)
+            except OSError as e:
+                if e.errno != errno.ENOSPC or TMP_DIR == TMP_DIR_SISTEMA:
+                    raise
+                logger.warning("⚠️ Sem espaço em %s, usando %s", TMP_DIR, TMP_DIR_SISTEMA)
+                file.file.seek(len(inicio))
+                hasher = hashlib.sha256()
+                arquivo_temp, tamanho = await run_in_threadpool(_copiar_para_temp, file.file, hasher, inicio, TMP_DIR_SISTEMA)
+            fonte = arquivo_temp
+        del inicio
+        
+        # Limite de tamanho para Granite (cópia interrompida ao passar do limite)
+        if tamanho > MAX_UPLOAD_MB * 1024 * 1024:
+            raise _erro_tamanho(tamanho, exato=False)
+    except BaseException:
+        if arquivo_temp:
+            _remover_temp(arquivo_temp)
+        raise
+    
+    logger.info("📁 Arquivo válido: %d bytes (%.1fMB)", tamanho, tamanho / (1024 * 1024))
+    if arquivo_temp:
+        logger.info("💾 Arquivo salvo temporariamente: %s", arquivo_temp)
+    else:
+        logger.info("🧠 Arquivo pequeno, processando direto da memória")
+    return fonte, arquivo_temp, hasher.hexdigest()
+
+# Responde do cache pelo hash do conteúdo ou converte no pool e guarda. Devolve o corpo JSON
+async def _converter_com_cache(fonte: Union[str, "DocumentStream"], hash_conteudo: str, colunar: bool,
+                               ocr: bool, tabelas: bool, max_pixels: int) -> bytes:
+    # Mesmo PDF já processado? Responde direto do cache
+    chave = _chave_cache(hash_conteudo, colunar, ocr, tabelas, max_pixels)
+    corpo = await run_in_threadpool(_ler_cache, chave)
+    if corpo is not None:
+        logger.info("⚡ Cache hit: %s", hash_conteudo[:16])
+        return corpo
+    
+    # PROCESSAR COM GRANITE 🔥 (no pool de processos, fora do event loop)
+    async with _semaforo:
+        # Serializado uma vez no worker: os mesmos bytes vão para o cache e para a resposta
+        corpo, status, imagens = await _executar_no_pool(_processar_em_worker, fonte, hash_conteudo[:16], colunar, ocr, tabelas, max_pixels)
+    
+    # Só guarda no cache resultados completos com Granite
+    if status == "sucesso_com_granite":
+        await run_in_threadpool(_gravar_cache, chave, corpo, imagens)
+    
+    logger.info("✅ Processamento concluído com sucesso!")
+    return corpo
+
+# DOWNLOAD POR URL
+def _cliente_http() -> "httpx.AsyncClient":
+    global _http
+    if _http is None:
+        # Redirects seguidos à mão em _abrir_url, validando cada destino
+        _http = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=False,
+            timeout=DOWNLOAD_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _http
+
+# Destino permitido? Esquema http(s), host na lista e todos os IPs resolvidos públicos
+async def _validar_destino(url: "httpx.URL"):
+    if url.scheme not in ("http", "https") or not url.host:
+        raise HTTPException(status_code=400, detail="URL deve ser http:// ou https://")
+    host = url.host.lower()
+    if host not in URL_HOSTS_PERMITIDOS:
+        raise HTTPException(status_code=403, detail=f"Host não permitido: {host}")
+    porta = url.port or (443 if url.scheme == "https" else 80)
+    try:
+        enderecos = await asyncio.get_running_loop().getaddrinfo(host, porta, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise HTTPException(status_code=400, detail=f"Host não encontrado: {host}")
+    for *_, sockaddr in enderecos:
+        ip = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise HTTPException(status_code=403, detail="URL aponta para um endereço interno")
+
+# Abre a URL em streaming seguindo redirects à mão: cada salto passa por _validar_destino.
+# Quem chama fecha a resposta (aclose)
+async def _abrir_url(metodo: str, url: "httpx.URL") -> "httpx.Response":
+    cliente = _cliente_http()
+    pedido = cliente.build_request(metodo, url)
+    for _ in range(MAX_REDIRECTS + 1):
+        await _validar_destino(pedido.url)
+        r = await cliente.send(pedido, stream=True)
+        if r.next_request is None:
+            return r
+        await r.aclose()
+        pedido = r.next_request
+    raise HTTPException(status_code=400, detail="Redirecionamentos demais")
+
+# Só URLs com ETag entram no índice (sem ETag não dá para saber se o arquivo mudou)
+def _caminho_indice_url(url: str, etag: str) -> str:
+    return os.path.join(URLS_DIR, hashlib.sha256(f"{url}|{etag}".encode()).hexdigest())
+
+def _ler_indice_url(url: str, etag: str) -> Optional[str]:
+    caminho = _caminho_indice_url(url, etag)
+    try:
+        with open(caminho, encoding="ascii") as f:
+            hash_conteudo = f.read().strip() or None
+        os.utime(caminho)  # LRU, podado junto com o cache
+        return hash_conteudo
+    except FileNotFoundError:
+        return None
+
+# Falha aqui só custa um download a mais no próximo request: loga e segue
+def _gravar_indice_url(url: str, etag: str, hash_conteudo: str):
+    caminho = _caminho_indice_url(url, etag)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=URLS_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="ascii") as f:
+            f.write(hash_conteudo)
+        os.replace(tmp, caminho)
+    except Exception as e:
+        logger.warning("⚠️ Erro gravando índice da URL %s: %s", url, e)
+        if tmp is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+# Baixa o PDF em streaming: pequeno fica em memória, grande vai para o temporário (mesmo limiar do upload).
+# Devolve (fonte, arquivo temporário ou None, hash do conteúdo, ETag)
+async def _baixar_pdf(url: "httpx.URL"):
+    limiar = FILE_SIZE_MB_THRESHOLD * 1024 * 1024
+    limite = MAX_UPLOAD_MB * 1024 * 1024
+    nome = os.path.basename(url.path) or "documento.pdf"
+    hasher = hashlib.sha256()
+    buffer = BytesIO()
+    tmp = None
+    tamanho = 0
+    try:
+        r = await _abrir_url("GET", url)
+        try:
+            if r.status_code != 200:
+                raise HTTPException(status_code=400, detail=f"Download falhou: HTTP {r.status_code}")
+            declarado = r.headers.get("content-length", "")
+            if declarado.isdigit() and int(declarado) > limite:
+                raise _erro_tamanho(int(declarado))
+            etag = r.headers.get("etag")
+            
+            async for bloco in r.aiter_bytes(CHUNK_UPLOAD):
+                hasher.update(bloco)
+                tamanho += len(bloco)
+                if tamanho > limite:
+                    raise _erro_tamanho(tamanho, exato=False)
+                if tmp is not None:
+                    await run_in_threadpool(tmp.write, bloco)
+                    continue
+                buffer.write(bloco)
+                # Assinatura do PDF assim que chegam os primeiros bytes
+                if tamanho - len(bloco) < 5 <= tamanho and not buffer.getvalue().startswith(b'%PDF-'):
+                    raise HTTPException(status_code=400, detail="URL não aponta para um PDF válido")
+                if tamanho > limiar:
+                    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf', dir=TMP_DIR)
+                    await run_in_threadpool(tmp.write, buffer.getbuffer())
+                    buffer = None
+        finally:
+            await r.aclose()
+        
+        if tamanho < 5:
+            raise HTTPException(status_code=400, detail="URL não aponta para um PDF válido")
+        if tmp is not None:
+            tmp.close()
+            fonte = tmp.name
+        else:
+            buffer.seek(0)
+            fonte = DocumentStream(name=nome, stream=buffer)
+    except BaseException:
+        if tmp is not None:
+            tmp.close()
+            _remover_temp(tmp.name)
+        raise
+    
+    logger.info("🌐 Baixado: %d bytes (%.1fMB)", tamanho, tamanho / (1024 * 1024))
+    return fonte, (tmp.name if tmp is not None else None), hasher.hexdigest(), etag
+
+def _validar_opcoes(layout: str, max_pixels: int, ocr: bool, tabelas: bool):
+    if (ocr, tabelas) not in COMBINACOES_ATIVAS:
+        ativas = ", ".join(n for n, c in COMBINACOES.items() if c in COMBINACOES_ATIVAS)
+        raise HTTPException(status_code=400, detail=f"Combinação ocr={ocr}, tabelas={tabelas} não habilitada no servidor (ativas: {ativas})")
+    if layout not in ("elementos", "colunar"):
+        raise HTTPException(status_code=400, detail="layout deve ser 'elementos' ou 'colunar'")
+    if max_pixels < 0:
+        raise HTTPException(status_code=400, detail="max_pixels deve ser >= 0")
 
 # ENDPOINT PRINCIPAL
 @app.post("/convert")
-async def converter_documento(file: UploadFile = File(...)):
-    logger.info(f"📄 RECEBIDO: {file.filename}")
+async def converter_documento(
+    background: BackgroundTasks,
+    file: UploadFile = File(...),
+    layout: str = Query("elementos"),
+    ocr: bool = Form(True),  # PDFs digitais não precisam de OCR (2-3x mais rápido)
+    tabelas: bool = Form(True),
+    max_pixels: int = Form(MAX_PIXELS_PADRAO),  # 0 = imagens no tamanho original
+):
+    logger.info("📄 RECEBIDO: %s", file.filename)
     
     # Validações
-    if not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="Apenas arquivos PDF são aceitos")
+    _validar_opcoes(layout, max_pixels, ocr, tabelas)
+    colunar = layout == "colunar"
+    await _validar_pdf(file)
+    
+    if not DOCLING_OK:
+        raise HTTPException(status_code=500, detail="Docling não disponível")
     
-    # Ler arquivo
-    conteudo = await file.read()
-    tamanho_mb = len(conteudo) / (1024 * 1024)
+    arquivo_temp = None
+    ok = False
+    try:
+        fonte, arquivo_temp, hash_conteudo = await _receber_pdf(file)
+        corpo = await _converter_com_cache(fonte, hash_conteudo, colunar, ocr, tabelas, max_pixels)
+        ok = True
+        return _resposta_json(corpo)
+        
+    except HTTPException:
+        raise
+    except ErroProcessamento as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        logger.error("❌ ERRO GERAL: %s", e)
+        raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
     
-    # Limite de tamanho para Granite
-    if tamanho_mb > 25:  # Limite conservador
-        raise HTTPException(status_code=400, detail=f"Arquivo muito grande para Granite: {tamanho_mb:.1f}MB. Máximo: 25MB")
+    finally:
+        # Limpar arquivo temporário: no sucesso só depois que a resposta sair
+        # (erros não passam pelas background tasks, então removem na hora)
+        if arquivo_temp:
+            if ok:
+                background.add_task(_remover_temp, arquivo_temp)
+            else:
+                _remover_temp(arquivo_temp)
+
+# PDF POR URL: sem upload; URL + ETag já vistos respondem do cache sem baixar
+@app.post("/convert-url")
+async def converter_url(
+    background: BackgroundTasks,
+    url: str = Form(...),
+    layout: str = Query("elementos"),
+    ocr: bool = Form(True),
+    tabelas: bool = Form(True),
+    max_pixels: int = Form(MAX_PIXELS_PADRAO),
+):
+    logger.info("🌐 URL RECEBIDA: %s", url)
     
-    logger.info(f"📁 Arquivo válido: {len(conteudo)} bytes ({tamanho_mb:.1f}MB)")
+    _validar_opcoes(layout, max_pixels, ocr, tabelas)
+    colunar = layout == "colunar"
+    if not URL_HABILITADA:
+        raise HTTPException(status_code=404, detail="/convert-url desabilitado (DOCLING_CONVERT_URL=1 e DOCLING_URL_HOSTS para habilitar)")
+    if not HTTPX_OK:
+        raise HTTPException(status_code=500, detail="httpx não disponível")
+    # InvalidURL não é subclasse de HTTPError
+    try:
+        destino = httpx.URL(url)
+    except httpx.InvalidURL as e:
+        raise HTTPException(status_code=400, detail=f"URL inválida: {e}")
+    if not DOCLING_OK:
+        raise HTTPException(status_code=500, detail="Docling não disponível")
     
-    # Salvar arquivo temporário
     arquivo_temp = None
+    ok = False
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-            tmp.write(conteudo)
-            arquivo_temp = tmp.name
+        # HEAD barato: se a URL + ETag já apontam para um conteúdo em cache, nem baixa
+        with contextlib.suppress(httpx.HTTPError, httpx.InvalidURL):
+            cabecalhos = await _abrir_url("HEAD", destino)
+            await cabecalhos.aclose()
+            etag = cabecalhos.headers.get("etag") if cabecalhos.status_code == 200 else None
+            hash_conhecido = etag and await run_in_threadpool(_ler_indice_url, url, etag)
+            if hash_conhecido:
+                chave = _chave_cache(hash_conhecido, colunar, ocr, tabelas, max_pixels)
+                corpo = await run_in_threadpool(_ler_cache, chave)
+                if corpo is not None:
+                    logger.info("⚡ Cache hit por URL: %s", hash_conhecido[:16])
+                    ok = True
+                    return _resposta_json(corpo)
         
-        logger.info(f"💾 Arquivo salvo temporariamente: {arquivo_temp}")
+        try:
+            fonte, arquivo_temp, hash_conteudo, etag = await _baixar_pdf(destino)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise HTTPException(status_code=400, detail=f"Erro ao baixar a URL: {e}")
+        if etag:
+            await run_in_threadpool(_gravar_indice_url, url, etag, hash_conteudo)
         
-        # PROCESSAR COM GRANITE 🔥
-        resultado = processar_documento_granite(arquivo_temp)
+        # Cache pelo hash do conteúdo: mesmo PDF em URLs diferentes (ou enviado por upload) é convertido uma vez só
+        corpo = await _converter_com_cache(fonte, hash_conteudo, colunar, ocr, tabelas, max_pixels)
+        ok = True
+        return _resposta_json(corpo)
+    
+    except HTTPException:
+        raise
+    except ErroProcessamento as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        logger.error("❌ ERRO NA URL: %s", e)
+        raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
+    
+    finally:
+        if arquivo_temp:
+            if ok:
+                background.add_task(_remover_temp, arquivo_temp)
+            else:
+                _remover_temp(arquivo_temp)
+
+# LOTE: vários PDFs num único worker (convert_all), resposta na ordem dos arquivos
+@app.post("/convert-lote")
+async def converter_lote(
+    files: List[UploadFile] = File(...),
+    layout: str = Query("elementos"),
+    ocr: bool = Form(True),
+    tabelas: bool = Form(True),
+    max_pixels: int = Form(MAX_PIXELS_PADRAO),
+):
+    logger.info("📚 LOTE RECEBIDO: %d arquivos", len(files))
+    
+    _validar_opcoes(layout, max_pixels, "json", ocr, tabelas)
+    colunar = layout == "colunar"
+    if len(files) > MAX_ARQUIVOS_LOTE:
+        raise HTTPException(status_code=400, detail=f"Máximo de {MAX_ARQUIVOS_LOTE} arquivos por lote")
+    for file in files:
+        await _validar_pdf(file)
+    
+    if not DOCLING_OK:
+        raise HTTPException(status_code=500, detail="Docling não disponível")
+    
+    temporarios = []
+    try:
+        corpos = [None] * len(files)
+        chaves, pendentes = [], []
+        for i, file in enumerate(files):
+            fonte, arquivo_temp, hash_conteudo = await _receber_pdf(file)
+            if arquivo_temp:
+                temporarios.append(arquivo_temp)
+            chave = _chave_cache(hash_conteudo, colunar, ocr, tabelas, max_pixels)
+            chaves.append(chave)
+            corpos[i] = await run_in_threadpool(_ler_cache, chave)
+            if corpos[i] is None:
+                pendentes.append((i, fonte, hash_conteudo[:16]))
+        logger.info("⚡ Lote: %d do cache, %d para converter", len(files) - len(pendentes), len(pendentes))
         
-        logger.info("✅ Processamento concluído com sucesso!")
-        return JSONResponse(content=resultado)
+        if pendentes:
+            async with _semaforo_lote, _semaforo:
+                saidas = await _executar_no_pool(
+                    _processar_lote_em_worker,
+                    [fonte for _, fonte, _ in pendentes], [id_doc for _, _, id_doc in pendentes],
+                    colunar, ocr, tabelas, max_pixels
+                )
+            for (i, _, _), (corpo, status, imagens) in zip(pendentes, saidas):
+                corpos[i] = corpo
+                if status == "sucesso_com_granite":
+                    await run_in_threadpool(_gravar_cache, chaves[i], corpo, imagens)
         
+        # Corpos já serializados: só junta os bytes
+        itens = [
+            b'{"arquivo":' + orjson.dumps(file.filename) + b',"resultado":' + corpo + b'}'
+            for file, corpo in zip(files, corpos)
+        ]
+        logger.info("✅ Lote concluído!")
+        return _resposta_json(b'{"resultados":[' + b','.join(itens) + b']}')
+    
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ ERRO GERAL: {e}")
+        logger.error("❌ ERRO NO LOTE: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
     
     finally:
-        # Limpar arquivo temporário
-        if arquivo_temp and os.path.exists(arquivo_temp):
-            os.unlink(arquivo_temp)
-            logger.info("🗑️ Arquivo temporário removido")
+        for arquivo_temp in temporarios:
+            _remover_temp(arquivo_temp)
 
 # Endpoints adicionais
 @app.post("/test-granite")
-async def testar_granite(file: UploadFile = File(...)):
+async def testar_granite(background: BackgroundTasks, file: UploadFile = File(...)):
     """Endpoint específico para testar Granite"""
     logger.info("🧪 TESTE GRANITE ESPECÍFICO")
-    return await converter_documento(file)
+    return await converter_documento(background, file, layout="elementos", ocr=True, tabelas=True, max_pixels=MAX_PIXELS_PADRAO)
+
+_CORPO_TESTE = orjson.dumps({
+    "status": "Granite API OK", 
+    "docling": DOCLING_OK, 
+    "modelo": "granite-vision",
+    "endpoint_principal": "/convert",
+    "granite_ativo": True,
+    "porta": 9000
+})
 
 @app.get("/test")
-def teste():
-    return {
-        "status": "Granite API OK", 
-        "docling": DOCLING_OK, 
-        "modelo": "granite-vision",
-        "endpoint_principal": "/convert",
-        "granite_ativo": True,
-        "porta": 9000
+async def teste():
+    return _resposta_json(_CORPO_TESTE)
+
+_CORPO_STATUS = orjson.dumps({
+    "docling_disponivel": DOCLING_OK,
+    "granite_ativo": True,
+    "porta": 9000,
+    "endpoints": {
+        "principal": "/convert",
+        "lote": "/convert-lote",
+        "url": "/convert-url",
+        "teste": "/test-granite",
+        "status": "/test"
+    },
+    "limites": {
+        "tamanho_max": "25MB",
+        "formatos": ["PDF"]
+    },
+    "recursos": {
+        "vlm": "granite-vision",
+        "ocr": True,
+        "tabelas": True,
+        "imagens": True,
+        "combinacoes": [n for n, c in COMBINACOES.items() if c in COMBINACOES_ATIVAS]
     }
+})
 
 @app.get("/status")
-def status_detalhado():
-    return {
-        "docling_disponivel": DOCLING_OK,
-        "granite_ativo": True,
-        "porta": 9000,
-        "endpoints": {
-            "principal": "/convert",
-            "teste": "/test-granite",
-            "status": "/test"
-        },
-        "limites": {
-            "tamanho_max": "25MB",
-            "formatos": ["PDF"]
-        },
-        "recursos": {
-            "vlm": "granite-vision",
-            "ocr": True,
-            "tabelas": True,
-            "imagens": True
-        }
-    }
+async def status_detalhado():
+    return _resposta_json(_CORPO_STATUS)
 
 if __name__ == "__main__":
     logger.info("🚀 Servidor Docling Granite iniciado na PORTA 9000!")
     logger.info("🔥 Granite Vision ATIVO!")
     logger.info("📋 Endpoints:")
     logger.info("  - POST http://localhost:9000/convert (principal)")
+    logger.info("  - POST http://localhost:9000/convert-lote (vários PDFs)")
+    logger.info("  - POST http://localhost:9000/convert-url (PDF por URL)")
     logger.info("  - POST http://localhost:9000/test-granite (teste)")
     logger.info("  - GET http://localhost:9000/test (status)")
     logger.info("  - GET http://localhost:9000/status (detalhes)")
     
+    # Workers HTTP (cada um com seu pool de DOCLING_WORKERS processos de conversão)
+    web_workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    logger.info("🧵 Workers HTTP: %d | Workers de conversão por processo: %d", web_workers, N_WORKERS)
+    
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=9000)
\ No newline at end of file
+    # uvloop + httptools: loop e parser HTTP em C (menos overhead por request)
+    uvicorn.run("server:app", host="0.0.0.0", port=9000, workers=web_workers, loop="uvloop", http="httptools")
\ No newline at end of file